@@ -1,10 +1,16 @@
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 import torch
 # from tensorboardX import SummaryWriter
 import wandb
 
 use_cuda = torch.cuda.is_available()
 
+# 체크포인트 저장은 백그라운드 스레드 하나에서 순서대로 처리
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1)
+_PENDING = []
+
 default_checkpoint = {
     "epoch": 0,
     "train_losses": [],
@@ -26,19 +32,79 @@ default_checkpoint = {
 }
 
 
-def save_checkpoint(checkpoint, dir="./checkpoints", prefix=""):
-    filename = f"{checkpoint['network']}_best_model.pth"
+def _flush(data, path):
+    # 임시 파일에 쓴 뒤 교체해서 쓰다 만 체크포인트가 남지 않도록 함
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _submit(checkpoint, path):
+    # 메인 스레드에서 메모리로 직렬화해 저장 시점의 state_dict를 고정하고,
+    # 디스크 쓰기만 백그라운드로 넘겨 다음 epoch 학습과 겹치게 함
+    global _PENDING
+    buf = io.BytesIO()
+    torch.save(checkpoint, buf)
+    buf.seek(0)
+    # 끝난 저장 작업은 결과를 확인해 백그라운드에서 실패한 쓰기도 여기서 에러로 드러나게 함
+    finished, running = [], []
+    for future in _PENDING:
+        (finished if future.done() else running).append(future)
+    _PENDING = running
+    _PENDING.append(_SAVE_POOL.submit(_flush, buf.getbuffer(), path))
+    for future in finished:
+        future.result()
+
+
+def save_checkpoint(checkpoint, dir="./checkpoints", prefix="", is_best=True, save_latest=False):
+    """체크포인트 저장
+
+    - is_best: optimizer/scheduler state를 뺀 bf16 weight를 `{network}_best_model.pth`로 저장 (inference용)
+    - save_latest: optimizer state까지 포함한 FP32 전체 state를 `{network}_latest.pth`로 덮어씀 (resume용)
+    """
     if not os.path.exists(os.path.join(prefix, dir)):
         os.makedirs(os.path.join(prefix, dir))
-    torch.save(checkpoint, os.path.join(prefix, dir, filename))
 
+    if is_best:
+        best = {k: v for k, v in checkpoint.items() if k not in ("optimizer", "scheduler")}
+        best["model"] = {
+            k: v.to(torch.bfloat16).cpu() if v.is_floating_point() else v.cpu()
+            for k, v in checkpoint["model"].items()
+        }
+        filename = f"{checkpoint['network']}_best_model.pth"
+        _submit(best, os.path.join(prefix, dir, filename))
 
-def load_checkpoint(path, cuda=use_cuda):
-    if cuda:
-        return torch.load(path)
-    else:
-        # Load GPU model on CPU
-        return torch.load(path, map_location=lambda storage, loc: storage)
+    if save_latest:
+        filename = f"{checkpoint['network']}_latest.pth"
+        _submit(checkpoint, os.path.join(prefix, dir, filename))
+
+
+def wait_for_checkpoints():
+    """백그라운드에서 진행 중인 체크포인트 저장이 모두 끝날 때까지 대기"""
+    global _PENDING
+    for future in _PENDING:
+        future.result()
+    _PENDING = []
+
+
+def load_checkpoint(path, cuda=use_cuda, weights_only=False):
+    """체크포인트 로드 (torch>=2.1)
+
+    mmap으로 필요한 부분만 읽어 전체 파일을 host 메모리에 올리지 않음.
+    weights_only=True는 tensor와 기본 type만 있는 파일에만 사용 가능
+    (numpy scalar가 들어간 이전 체크포인트는 torch 2.1의 weights-only unpickler가 거부함)
+    """
+    return torch.load(
+        path,
+        map_location="cuda" if cuda else "cpu",
+        mmap=True,
+        weights_only=weights_only,
+    )
 
 
 # def init_tensorboard(name="", base_dir="./tensorboard"):
@@ -99,11 +165,20 @@ def write_wandb(
     validation_symbol_accuracy,
     validation_sentence_accuracy,
     validation_wer,
-    validation_score
+    validation_score,
+    lr,
+    tf_ratio=None
 ): 
+    # scheduler에 따라 get_lr()이 float(CircularLRBeta) 또는 param group별 list를 반환
+    if not isinstance(lr, (float, int)):
+        lr = lr[0]
+    extra = {} if tf_ratio is None else dict(tf_ratio=tf_ratio)
+
+    # 한 epoch의 값을 모두 모아 한 번의 wandb.log로 기록
     wandb.log(
         dict(
             epoch=epoch,
+            learning_rate=lr,
             train_loss=train_loss,
             train_symbol_accuracy=train_symbol_accuracy,
             train_sentence_accuracy=train_sentence_accuracy,
@@ -114,6 +189,7 @@ def write_wandb(
             validation_sentence_accuracy=validation_sentence_accuracy,
             validation_wer=validation_wer,
             validation_score=validation_score,
-            grad_norm=grad_norm
+            grad_norm=grad_norm,
+            **extra
         )
     )
\ No newline at end of file
@@ -2,9 +2,9 @@ import torch
 from torch import nn
 
 
-def get_criterion(type: str):
+def get_criterion(type: str, ignore_index: int = -100):
     if type == 'CE':
-        criterion = nn.CrossEntropyLoss()
+        criterion = nn.CrossEntropyLoss(ignore_index=ignore_index)
     else:
         raise NotImplementedError
     return criterion
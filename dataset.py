@@ -1,6 +1,7 @@
 import os
 import csv
 import random
+from functools import partial
 import numpy as np
 import pandas as pd
 from typing import *
@@ -103,8 +104,16 @@ def split_gt(groundtruth: str, proportion: float=1.0, test_percent=None) -> Tupl
 
 
 
-def collate_batch(data):
-    max_len = max([len(d["truth"]["encoded"]) for d in data])
+def collate_batch(data, max_len=None):
+    # max_len 지정 시 모든 batch를 같은 길이로 padding - CUDA Graph처럼 고정 shape이 필요한 경우
+    batch_max_len = max([len(d["truth"]["encoded"]) for d in data])
+    if max_len is None:
+        max_len = batch_max_len
+    elif batch_max_len > max_len:
+        # 잘라내면 <EOS>가 사라져 잘못된 target으로 학습하게 되므로 에러
+        raise ValueError(
+            f"encoded sequence length {batch_max_len} exceeds max_seq_len {max_len}"
+        )
     # Padding with -1, will later be replaced with the PAD token
     padded_encoded = [
         d["truth"]["encoded"] + (max_len - len(d["truth"]["encoded"])) * [-1]
@@ -306,18 +315,33 @@ def dataset_loader(options, train_transform, valid_transform):
             valid = split_gt(path)
             valid_data += valid
 
+    # pinned memory로 H2D 복사를 non_blocking으로 수행하고, worker는 epoch 간 재사용
+    loader_kwargs = dict(num_workers=options.num_workers, pin_memory=True)
+    if options.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # CUDA Graph 사용 시에만 학습 batch를 max_seq_len으로 고정
+    fixed_len = getattr(options, "max_seq_len", None) if getattr(options, "cuda_graph", False) else None
+
     # Load data
     train_dataset = LoadDataset(
         # train_data, options.data.token_paths, crop=options.data.crop, transform=transformed, rgb=options.data.rgb
         train_data, options.data.token_paths, crop=options.data.crop, transform=train_transform, rgb=options.data.rgb
     )
+    # collate_batch에서 에러가 나면 학습 도중 worker가 죽으므로 학습 시작 전에 한 번만 확인
+    if fixed_len is not None:
+        longest = max(len(d["truth"]["encoded"]) for d in train_dataset.data)
+        if longest > fixed_len:
+            raise ValueError(
+                f"encoded sequence length {longest} exceeds max_seq_len {fixed_len}"
+            )
     train_data_loader = DataLoader(
         train_dataset,
         batch_size=options.batch_size,
         shuffle=True,
-        num_workers=options.num_workers,
-        collate_fn=collate_batch,
+        collate_fn=partial(collate_batch, max_len=fixed_len),
         drop_last=True,
+        **loader_kwargs,
     )
 
     valid_dataset = LoadDataset(
@@ -328,9 +352,9 @@ def dataset_loader(options, train_transform, valid_transform):
         valid_dataset,
         batch_size=options.batch_size,
         shuffle=False,
-        num_workers=options.num_workers,
         collate_fn=collate_batch,
         drop_last=True,
+        **loader_kwargs,
     )
 
     return train_data_loader, valid_data_loader, train_dataset, valid_dataset
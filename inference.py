@@ -85,7 +85,7 @@ def main(parser):
                     method=parser.decode_type, 
                     beam_width=parser.beam_width
                     )
-            sequence_str = id_to_string(sequence, test_data_loader, do_eval=1)
+            sequence_str = id_to_string(sequence, test_data_loader.dataset.id_to_token, do_eval=1, token_to_id=test_data_loader.dataset.token_to_id)
             
             for path, predicted in zip(d["file_path"], sequence_str):
                 results.append((path, predicted))
@@ -284,8 +284,9 @@ class PositionalEncoding2D(nn.Module):
     def __init__(self, in_channels, max_h=64, max_w=128, dropout=0.1):
         super(PositionalEncoding2D, self).__init__()
 
-        self.h_position_encoder = self.generate_encoder(in_channels // 2, max_h)
-        self.w_position_encoder = self.generate_encoder(in_channels // 2, max_w)
+        # buffer로 등록해 model.to(device) 시 함께 옮겨지도록 함 (매 step H2D 복사 방지)
+        self.register_buffer("h_position_encoder", self.generate_encoder(in_channels // 2, max_h), persistent=False)
+        self.register_buffer("w_position_encoder", self.generate_encoder(in_channels // 2, max_w), persistent=False)
 
         self.h_linear = nn.Linear(in_channels // 2, in_channels // 2)
         self.w_linear = nn.Linear(in_channels // 2, in_channels // 2)
@@ -435,8 +436,8 @@ class PositionEncoder1D(nn.Module):
     def __init__(self, in_channels, max_len=500, dropout=0.1):
         super(PositionEncoder1D, self).__init__()
 
-        self.position_encoder = self.generate_encoder(in_channels, max_len) # [MAX_LEN, IN_CHANNELS(HIDDEN)]
-        self.position_encoder = self.position_encoder.unsqueeze(0) # [1, MAX_LEN, IN_CHANNELS(HIDDEN)]
+        position_encoder = self.generate_encoder(in_channels, max_len) # [MAX_LEN, IN_CHANNELS(HIDDEN)]
+        self.register_buffer("position_encoder", position_encoder.unsqueeze(0), persistent=False) # [1, MAX_LEN, IN_CHANNELS(HIDDEN)]
         self.dropout = nn.Dropout(p=dropout)
 
     def generate_encoder(self, in_channels, max_len):
@@ -535,8 +536,8 @@ class TransformerDecoder(nn.Module):
         Returns:
             torch.Tensor: Masking Square Matrix, [1, LENGTH, LENGTH]
         """
-        order_mask = torch.triu(torch.ones(length, length), diagonal=1).bool()
-        order_mask = order_mask.unsqueeze(0).to(device)
+        order_mask = torch.triu(torch.ones(length, length, device=device), diagonal=1).bool()
+        order_mask = order_mask.unsqueeze(0)
         return order_mask
 
     def text_embedding(self, texts):
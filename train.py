@@ -2,6 +2,7 @@ import os
 import argparse
 import random
 import time
+import itertools
 from tqdm import tqdm
 import yaml
 import shutil
@@ -19,6 +20,7 @@ from checkpoint import (
     default_checkpoint,
     load_checkpoint,
     save_checkpoint,
+    wait_for_checkpoints,
     # init_tensorboard,
     # write_tensorboard,
     write_wandb
@@ -78,7 +80,9 @@ def train_one_epoch(
     torch.set_grad_enabled(True)
     model.train()
 
-    losses = []
+    # 매 step loss.item()으로 동기화하지 않도록 GPU에서 합산
+    loss_sum = torch.zeros((), device=device)
+    loss_n = 0
     grad_norms = []
     correct_symbols = 0
     total_symbols = 0
@@ -87,6 +91,13 @@ def train_one_epoch(
     sent_acc = 0
     num_sent_acc = 0
 
+    # loop 밖에서 vocab을 한 번만 꺼내둠
+    id_to_token = data_loader.dataset.id_to_token
+    token_to_id = data_loader.dataset.token_to_id
+    pad_id = token_to_id[PAD]
+    # 매 step 동일하므로 loop 밖에서 한 번만 계산
+    optim_params = list(itertools.chain.from_iterable(g["params"] for g in optimizer.param_groups))
+
     with tqdm(
         desc=f"{epoch_text} Train",
         total=len(data_loader.dataset),
@@ -100,24 +111,19 @@ def train_one_epoch(
             curr_batch_size = len(input)
             expected = d["truth"]["encoded"].to(device)
 
-            expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
+            # 모델 입력용으로만 -1을 PAD로 바꾼 텐서를 만들고 expected는 metric 계산용으로 유지
+            expected_in = torch.where(expected == -1, pad_id, expected)
 
             # with autocast():
-            output = model(input, expected, True, tf_ratio) # NOTE. Teacher Forcing Scheduler
+            output = model(input, expected_in, True, tf_ratio) # NOTE. Teacher Forcing Scheduler
 #             output = model(input, expected, True, teacher_forcing_ratio) # [B, MAX_LEN, VOCAB_SIZE]
 
             decoded_values = output.transpose(1, 2) # [B, VOCAB_SIZE, MAX_LEN]
-            _, sequence = torch.topk(decoded_values, k=1, dim=1) # [B, 1, MAX_LEN]
-            sequence = sequence.squeeze(1) # [B, MAX_LEN], Metric 측정을 위해
+            sequence = decoded_values.argmax(dim=1) # [B, MAX_LEN], Metric 측정을 위해
 
-            loss = criterion(decoded_values, expected[:, 1:]) # [SOS] 이후부터
+            loss = criterion(decoded_values, expected_in[:, 1:]) # [SOS] 이후부터
 
-            optim_params = [
-                p
-                for param_group in optimizer.param_groups
-                for p in param_group["params"]
-            ]
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             # scaler.scale(loss).backward()
             # scaler.unscale_(optimizer)
@@ -129,11 +135,11 @@ def train_one_epoch(
             # scaler.step(optimizer)
             # scaler.update()
             optimizer.step()
-            losses.append(loss.item())
+            loss_sum += loss.detach()
+            loss_n += 1
 
-            expected[expected == data_loader.dataset.token_to_id[PAD]] = -1
-            expected_str = id_to_string(expected, data_loader, do_eval=1)
-            sequence_str = id_to_string(sequence, data_loader, do_eval=1)
+            expected_str = id_to_string(expected, id_to_token, do_eval=1, token_to_id=token_to_id)
+            sequence_str = id_to_string(sequence, id_to_token, do_eval=1, token_to_id=token_to_id)
             wer += word_error_rate(sequence_str, expected_str)
             num_wer += 1
             sent_acc += sentence_acc(sequence_str, expected_str)
@@ -144,36 +150,24 @@ def train_one_epoch(
             pbar.update(curr_batch_size)
             lr_scheduler.step()
 
-            # lr logging
-            if isinstance(lr_scheduler.get_lr(), float) or isinstance(lr_scheduler.get_lr(), int):
-                wandb.log({
-                    "learning_rate": lr_scheduler.get_lr(),
-                    'tf_ratio': tf_ratio # NOTE. Teacher Forcing Scheduler
-                    })
-            else:
-                for lr_ in lr_scheduler.get_lr():
-                    wandb.log({
-                        "learning_rate": lr_,
-                        'tf_ratio': tf_ratio # NOTE. Teacher Forcing Scheduler
-                        })
-
-    expected = id_to_string(expected, data_loader)
-    sequence = id_to_string(sequence, data_loader)
+    expected = id_to_string(expected, id_to_token)
+    sequence = id_to_string(sequence, id_to_token)
 
     result = {
-        "loss": np.mean(losses),
+        "loss": (loss_sum / loss_n).item(),
         "correct_symbols": correct_symbols,
         "total_symbols": total_symbols,
         "wer": wer,
         "num_wer": num_wer,
         "sent_acc": sent_acc,
         "num_sent_acc": num_sent_acc,
+        "tf_ratio": tf_ratio, # NOTE. Teacher Forcing Scheduler, epoch 마지막 값을 write_wandb로 기록
     }
 
     try:
-        result["grad_norm"] = np.mean([tensor.cpu() for tensor in grad_norms])
+        result["grad_norm"] = float(np.mean([tensor.cpu() for tensor in grad_norms]))
     except:
-        result["grad_norm"] = np.mean(grad_norms)
+        result["grad_norm"] = float(np.mean(grad_norms))
 
     return result
 
@@ -183,7 +177,8 @@ def valid_one_epoch(
 ):
     model.eval()
 
-    losses = []
+    loss_sum = torch.zeros((), device=device)
+    loss_n = 0
     correct_symbols = 0
     total_symbols = 0
     wer = 0
@@ -191,6 +186,11 @@ def valid_one_epoch(
     sent_acc = 0
     num_sent_acc = 0
 
+    # loop 밖에서 vocab을 한 번만 꺼내둠
+    id_to_token = data_loader.dataset.id_to_token
+    token_to_id = data_loader.dataset.token_to_id
+    pad_id = token_to_id[PAD]
+
     with torch.no_grad():
         with tqdm(
             desc=f"{epoch_text} Validation",
@@ -204,21 +204,20 @@ def valid_one_epoch(
                 curr_batch_size = len(input)
                 expected = d["truth"]["encoded"].to(device)
 
-                expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
+                expected_in = torch.where(expected == -1, pad_id, expected)
                 # with autocast():
-                output = model(input, expected, False, teacher_forcing_ratio)
+                output = model(input, expected_in, False, teacher_forcing_ratio)
 
                 decoded_values = output.transpose(1, 2) # [B, VOCAB_SIZE, MAX_LEN]
-                _, sequence = torch.topk(decoded_values, 1, dim=1) # sequence: [B, 1, MAX_LEN]
-                sequence = sequence.squeeze(1) # [B, MAX_LEN], 각 샘플에 대해 시퀀스가 생성 상태
+                sequence = decoded_values.argmax(dim=1) # [B, MAX_LEN], 각 샘플에 대해 시퀀스가 생성 상태
 
-                loss = criterion(decoded_values, expected[:, 1:])
+                loss = criterion(decoded_values, expected_in[:, 1:])
 
-                losses.append(loss.item())
+                loss_sum += loss.detach()
+                loss_n += 1
 
-                expected[expected == data_loader.dataset.token_to_id[PAD]] = -1
-                expected_str = id_to_string(expected, data_loader, do_eval=1)
-                sequence_str = id_to_string(sequence, data_loader, do_eval=1)
+                expected_str = id_to_string(expected, id_to_token, do_eval=1, token_to_id=token_to_id)
+                sequence_str = id_to_string(sequence, id_to_token, do_eval=1, token_to_id=token_to_id)
                 wer += word_error_rate(sequence_str, expected_str)
                 num_wer += 1
                 sent_acc += sentence_acc(sequence_str, expected_str)
@@ -228,11 +227,11 @@ def valid_one_epoch(
 
                 pbar.update(curr_batch_size)
 
-    expected = id_to_string(expected, data_loader)
-    sequence = id_to_string(sequence, data_loader)
+    expected = id_to_string(expected, id_to_token)
+    sequence = id_to_string(sequence, id_to_token)
 
     result = {
-        "loss": np.mean(losses),
+        "loss": (loss_sum / loss_n).item(),
         "correct_symbols": correct_symbols,
         "total_symbols": total_symbols,
         "wer": wer,
@@ -271,6 +270,9 @@ def main(config_file):
     Train math formula recognition model
     """
     options = Flags(config_file).get()
+    # 체크포인트에 함께 저장할 config (학습 중 변하지 않으므로 한 번만 읽음)
+    with open(config_file, "r") as f:
+        option_dict = yaml.safe_load(f)
     timestamp = get_timestamp()
 
     # set random seed
@@ -435,8 +437,10 @@ def main(config_file):
             lr_scheduler = CircularLRBeta(
                 optimizer, options.optimizer.lr, 10, 10, cycle, [0.95, 0.85]
             )
-    if checkpoint['scheduler']:
-        lr_scheduler.load_state_dict(checkpoint['scheduler'])
+    # best_model.pth에는 scheduler state가 없으므로 optimizer와 같이 get으로 확인
+    scheduler_state = checkpoint.get("scheduler")
+    if scheduler_state:
+        lr_scheduler.load_state_dict(scheduler_state)
 
     # Log for W&B
     wandb.config.update(dict(options._asdict()))  # logging to W&B
@@ -464,6 +468,7 @@ def main(config_file):
     scaler = GradScaler()
 
     best_score = 0.0
+    ckpt_interval = getattr(options, "ckpt_interval", 1)
 
     # Train
     for epoch in range(options.num_epochs):
@@ -535,12 +540,12 @@ def main(config_file):
         )
 
         # Save checkpoint
-        # make config
-        with open(config_file, "r") as f:
-            option_dict = yaml.safe_load(f)
-        if best_score < 0.9 * validation_epoch_sentence_accuracy + 0.1 * (
+        is_best = best_score < 0.9 * validation_epoch_sentence_accuracy + 0.1 * (
             1 - validation_epoch_wer
-        ):
+        )
+        # optimizer state를 포함한 resume용 체크포인트는 ckpt_interval epoch마다 저장
+        save_latest = (epoch + 1) % ckpt_interval == 0 or epoch == options.num_epochs - 1
+        if is_best or save_latest:
             # prefix = f"{parser.project_name}-{parser.exp_name}-{timestamp}"
             save_checkpoint(
                 {
@@ -565,7 +570,10 @@ def main(config_file):
                 },
                 prefix=options.prefix,
                 # prefix=prefix,
+                is_best=is_best,
+                save_latest=save_latest,
             )
+        if is_best:
             best_score = 0.9 * validation_epoch_sentence_accuracy + 0.1 * (
                 1 - validation_epoch_wer
             )
@@ -630,7 +638,9 @@ def main(config_file):
                 validation_symbol_accuracy=validation_epoch_symbol_accuracy,
                 validation_sentence_accuracy=validation_epoch_sentence_accuracy,
                 validation_wer=validation_epoch_wer,
-                validation_score=validation_epoch_score
+                validation_score=validation_epoch_score,
+                lr=epoch_lr,
+                tf_ratio=train_result["tf_ratio"]
             )
 
 
@@ -660,5 +670,8 @@ if __name__ == "__main__":
     # train
     main(parser.config_file)
 
+    # 백그라운드 체크포인트 저장 완료 대기
+    wait_for_checkpoints()
+
     # fishe W&B
     run.finish()
@@ -2,17 +2,20 @@ import os
 import argparse
 import random
 import time
+import itertools
+import collections
 from tqdm import tqdm
 import yaml
 import shutil
 from psutil import virtual_memory
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torchvision import transforms
-from torch.cuda.amp import autocast, GradScaler
+from torch.cuda.amp import GradScaler
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import wandb
@@ -20,8 +23,7 @@ from checkpoint import (
     default_checkpoint,
     load_checkpoint,
     save_checkpoint,
-    init_tensorboard,
-    write_tensorboard,
+    wait_for_checkpoints,
     write_wandb # added
 )
 from flags import Flags
@@ -30,15 +32,162 @@ from utils import (
     print_system_envs, 
     get_optimizer, 
     get_network, 
-    id_to_string
+    id_to_string,
+    enable_gradient_checkpointing
     )
 from dataset import dataset_loader, START, PAD,load_vocab
-from scheduler import CircularLRBeta, CustomCosineAnnealingWarmUpRestarts
+from scheduler_ import CircularLRBeta, CustomCosineAnnealingWarmUpRestarts
 from criterion import get_criterion
-from metrics import word_error_rate, sentence_acc, final_metric
+from metrics_ import word_error_rate, sentence_acc, final_metric
 os.environ["WANDB_LOG_MODEL"] = "true"
 os.environ["WANDB_WATCH"] = "all"
 
+# 문자열 변환 및 WER/sentence acc 계산을 학습 프로세스 밖에서 수행하는 worker pool (main에서 vocab을 읽은 뒤 생성)
+_METRIC_POOL = None
+# worker 프로세스가 initializer로 한 번만 받아두는 vocab
+_WORKER_VOCAB = {}
+
+
+def _init_metric_worker(id_to_token, token_to_id):
+    _WORKER_VOCAB["id_to_token"] = id_to_token
+    _WORKER_VOCAB["token_to_id"] = token_to_id
+
+
+def start_metric_pool(id_to_token, token_to_id, max_workers=2):
+    """metric worker pool 생성
+
+    CUDA와 pin memory/체크포인트/wandb 스레드가 이미 떠 있는 프로세스를 fork하면 deadlock이 날 수 있어
+    spawn으로 띄우고, 매 batch마다 vocab을 pickle하지 않도록 initializer로 한 번만 넘김
+    """
+    global _METRIC_POOL
+    _METRIC_POOL = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_metric_worker,
+        initargs=(id_to_token, token_to_id),
+    )
+
+
+def _compute_batch_metrics(sequence, expected):
+    id_to_token = _WORKER_VOCAB["id_to_token"]
+    token_to_id = _WORKER_VOCAB["token_to_id"]
+    expected_str = id_to_string(expected, id_to_token, do_eval=1, token_to_id=token_to_id)
+    sequence_str = id_to_string(sequence, id_to_token, do_eval=1, token_to_id=token_to_id)
+    return word_error_rate(sequence_str, expected_str), sentence_acc(sequence_str, expected_str)
+
+
+class _MetricCopier:
+    """예측/정답 id를 pinned host buffer로 non_blocking 복사하고, 복사가 끝난 batch만 metric pool에 넘김
+
+    buffer를 num_buffers개 돌려 쓰므로 host는 num_buffers - 1 step 전 batch의 event만 기다림
+    """
+
+    def __init__(self, num_buffers=2):
+        self.buffers = [None] * num_buffers
+        self.in_flight = collections.deque()
+        self.futures = []
+        self.step = 0
+
+    def put(self, sequence, expected):
+        stacked = torch.stack((sequence, expected))
+        if not stacked.is_cuda:
+            self._submit(stacked.numpy())
+            return
+
+        # 재사용할 buffer로 복사 중인 batch가 남아있으면 먼저 pool로 넘김
+        while len(self.in_flight) >= len(self.buffers):
+            self._drain_one()
+
+        idx = self.step % len(self.buffers)
+        self.step += 1
+        if self.buffers[idx] is None or self.buffers[idx].numel() < stacked.numel():
+            self.buffers[idx] = torch.empty(stacked.numel(), dtype=stacked.dtype, pin_memory=True)
+        host = self.buffers[idx][:stacked.numel()].view(stacked.shape)
+        host.copy_(stacked, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self.in_flight.append((event, host))
+
+    def _drain_one(self):
+        event, host = self.in_flight.popleft()
+        event.synchronize()
+        # pool은 인자를 나중에 pickle하므로 buffer 재사용 전에 복사본을 넘김
+        self._submit(host.numpy().copy())
+
+    def _submit(self, stacked_np):
+        sequence_np, expected_np = stacked_np
+        self.futures.append(
+            _METRIC_POOL.submit(_compute_batch_metrics, sequence_np, expected_np)
+        )
+
+    def results(self):
+        while self.in_flight:
+            self._drain_one()
+        return [future.result() for future in self.futures]
+
+
+def _count_symbols(sequence, target, scratch):
+    """scratch의 bool 버퍼를 재사용해 (맞춘 symbol 수, PAD를 제외한 전체 symbol 수) 계산
+
+    scratch: {"eq": Tensor, "ne": Tensor}, 현재 batch보다 작으면 더 큰 크기로 다시 할당
+    """
+    b, l = target.shape
+    if scratch["eq"].size(0) < b or scratch["eq"].size(1) < l:
+        size = (max(b, scratch["eq"].size(0)), max(l, scratch["eq"].size(1)))
+        scratch["eq"] = torch.empty(size, dtype=torch.bool, device=target.device)
+        scratch["ne"] = torch.empty_like(scratch["eq"])
+    eq = scratch["eq"][:b, :l]
+    ne = scratch["ne"][:b, :l]
+    torch.ne(target, -1, out=ne)
+    torch.eq(sequence, target, out=eq)
+    torch.logical_and(eq, ne, out=eq)
+    return eq.sum(), ne.sum()
+
+def get_amp_dtype(device):
+    """Ampere 이상(bf16 지원)은 bf16, 그 외 GPU는 GradScaler와 함께 쓰는 fp16 autocast dtype"""
+    if device.type == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+def capture_train_step(model, criterion, input, expected_in, amp_dtype, scaler, warmup_steps=3):
+    """teacher forcing 학습 step의 forward + backward를 CUDA Graph로 capture
+
+    input/expected_in은 shape 고정을 위한 예시 batch로, 이후 replay 시에는 반환된
+    static 텐서에 새 batch를 copy_한 뒤 graph를 replay함.
+    optimizer.step과 gradient clipping은 lr scheduler가 매 step lr을 바꾸므로 graph 밖에서 수행.
+    fp16이면 scaler.scale()도 capture되며, scale 값은 scaler가 in-place로 갱신하므로 replay에 반영됨
+    """
+    static_input = input.clone()
+    static_expected = expected_in.clone()
+
+    # capture 전 side stream에서 warmup (cuDNN 커널 선택, allocator 초기화)
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup_steps):
+            model.zero_grad(set_to_none=True)
+            with torch.autocast(device_type="cuda", dtype=amp_dtype, cache_enabled=False):
+                output = model(static_input, static_expected, True, 1.0)
+                loss = criterion(output.transpose(1, 2), static_expected[:, 1:])
+            scaler.scale(loss).backward()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    # grad가 None인 상태에서 capture해야 replay 때 grad가 누적되지 않고 덮어써짐
+    model.zero_grad(set_to_none=True)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        with torch.autocast(device_type="cuda", dtype=amp_dtype, cache_enabled=False):
+            static_output = model(static_input, static_expected, True, 1.0)
+            static_loss = criterion(static_output.transpose(1, 2), static_expected[:, 1:])
+        scaler.scale(static_loss).backward()
+
+    return {
+        "graph": graph,
+        "input": static_input,
+        "expected": static_expected,
+        "output": static_output,
+        "loss": static_loss,
+    }
 
 def train_one_epoch(
     data_loader, 
@@ -49,90 +198,105 @@ def train_one_epoch(
     lr_scheduler, 
     teacher_forcing_ratio, 
     max_grad_norm, 
-    device, 
-    scaler
+    device,
+    metric_scratch,
+    amp_dtype,
+    scaler,
+    graph_step=None
     ):
     torch.set_grad_enabled(True)
     model.train()
 
-    losses = []
-    grad_norms = []
-    correct_symbols = 0
-    total_symbols = 0
-    wer = 0
-    num_wer = 0
-    sent_acc = 0
-    num_sent_acc = 0
+    loss_sum = torch.zeros((), device=device)
+    loss_n = 0
+    grad_norm_sum = torch.zeros((), device=device)
+    grad_norm_n = 0
+    correct_symbols = torch.zeros((), dtype=torch.long, device=device)
+    total_symbols = torch.zeros((), dtype=torch.long, device=device)
+    id_to_token = data_loader.dataset.id_to_token
+    metric_copier = _MetricCopier()
+
+    # 매 step 동일하므로 loop 밖에서 한 번만 계산
+    optim_params = list(itertools.chain.from_iterable(g["params"] for g in optimizer.param_groups))
+    pad_id = data_loader.dataset.token_to_id[PAD]
 
     with tqdm(desc=f"{epoch_text} Train", total=len(data_loader.dataset), dynamic_ncols=True, leave=False) as pbar:
         for d in data_loader:
-            input = d["image"].to(device).float()
+            input = d["image"].to(device, non_blocking=True).float().contiguous(memory_format=torch.channels_last)
 
             curr_batch_size = len(input)
-            expected = d["truth"]["encoded"].to(device)
+            expected = d["truth"]["encoded"].to(device, non_blocking=True)
 
-            expected[expected==-1] = data_loader.dataset.token_to_id[PAD]
+            # 모델 입력용으로만 -1을 PAD로 바꾼 텐서를 만들고 expected는 metric 계산용으로 유지
+            expected_in = torch.where(expected == -1, pad_id, expected)
 
-            with autocast():
-                output = model(input, expected, True, teacher_forcing_ratio)
+            if graph_step is None:
+                with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=device.type == "cuda"):
+                    output = model(input, expected_in, True, teacher_forcing_ratio)
 
-                decoded_values = output.transpose(1, 2)
-                _, sequence = torch.topk(decoded_values, 1, dim=1)
-                sequence = sequence.squeeze(1)
+                    decoded_values = output.transpose(1, 2)
+                    sequence = decoded_values.argmax(dim=1)
 
-                loss = criterion(decoded_values, expected[:, 1:])
+                    loss = criterion(decoded_values, expected_in[:, 1:])
 
-            optim_params = [p for param_group in optimizer.param_groups for p in param_group["params"]]
-            optimizer.zero_grad()
-            scaler.scale(loss).backward()
-            scaler.unscale_(optimizer)
+                optimizer.zero_grad(set_to_none=True)
+                # bf16은 FP32와 exponent 범위가 같아 scaler가 비활성화되어 있고, fp16일 때만 loss scaling
+                scaler.scale(loss).backward()
+            else:
+                # capture된 forward + backward를 replay, grad는 graph가 소유한 텐서에 덮어써지므로 zero_grad 불필요
+                graph_step["input"].copy_(input, non_blocking=True)
+                graph_step["expected"].copy_(expected_in, non_blocking=True)
+                graph_step["graph"].replay()
+
+                decoded_values = graph_step["output"].transpose(1, 2)
+                sequence = decoded_values.argmax(dim=1)
+                loss = graph_step["loss"]
 
+            scaler.unscale_(optimizer)
             grad_norm = nn.utils.clip_grad_norm_(
                 optim_params, max_norm=max_grad_norm
             )
-            grad_norms.append(grad_norm)
+            grad_norm_sum += grad_norm.detach()
+            grad_norm_n += 1
 
             # cycle
             scaler.step(optimizer)
             scaler.update()
 
-            losses.append(loss.item())
+            loss_sum += loss.detach()
+            loss_n += 1
+
+            batch_correct, batch_total = _count_symbols(sequence, expected[:, 1:], metric_scratch)
+            correct_symbols += batch_correct
+            total_symbols += batch_total
 
-            expected[expected == data_loader.dataset.token_to_id[PAD]] = -1
-            expected_str = id_to_string(expected, data_loader,do_eval=1)
-            sequence_str = id_to_string(sequence, data_loader,do_eval=1)
-            wer += word_error_rate(sequence_str,expected_str)
-            num_wer += 1
-            sent_acc += sentence_acc(sequence_str,expected_str)
-            num_sent_acc += 1
-            correct_symbols += torch.sum(sequence == expected[:, 1:], dim=(0, 1)).item()
-            total_symbols += torch.sum(expected[:, 1:] != -1, dim=(0, 1)).item()
+            # 예측/정답을 non_blocking으로 CPU에 옮기고 문자열 변환 및 WER 계산은 worker에서 수행
+            metric_copier.put(sequence, expected[:, 1:])
 
             pbar.update(curr_batch_size)
             lr_scheduler.step()
 
-    expected = id_to_string(expected, data_loader)
-    sequence = id_to_string(sequence, data_loader)
+    expected = id_to_string(expected, id_to_token)
+    sequence = id_to_string(sequence, id_to_token)
     # print("-" * 10 + "GT train")
     # print(*expected[:3], sep="\n")
     # print("-" * 10 + "PR train")
     # print(*sequence[:3], sep="\n")
     # print(f"{lr_scheduler.get_lr()[0]}\n")
 
+    batch_metrics = metric_copier.results()
+
     result = {
-        "loss": np.mean(losses),
-        "correct_symbols": correct_symbols,
-        "total_symbols": total_symbols,
-        "wer": wer,
-        "num_wer":num_wer,
-        "sent_acc": sent_acc,
-        "num_sent_acc":num_sent_acc
+        "loss": (loss_sum / loss_n).item(),
+        "correct_symbols": correct_symbols.item(),
+        "total_symbols": total_symbols.item(),
+        "wer": sum(batch_wer for batch_wer, _ in batch_metrics),
+        "num_wer": len(batch_metrics),
+        "sent_acc": sum(batch_sent_acc for _, batch_sent_acc in batch_metrics),
+        "num_sent_acc": len(batch_metrics)
     }
 
-    try:
-        result["grad_norm"] = np.mean([tensor.cpu() for tensor in grad_norms])
-    except:
-        result["grad_norm"] = np.mean(grad_norms)
+    result["grad_norm"] = (grad_norm_sum / max(grad_norm_n, 1)).item()
 
     return result
 
@@ -142,176 +306,66 @@ def valid_one_epoch(
     epoch_text, 
     criterion, 
     device, 
-    teacher_forcing_ratio
+    teacher_forcing_ratio,
+    metric_scratch,
+    amp_dtype
     ):
     model.eval()
 
-    losses = []
-    correct_symbols = 0
-    total_symbols = 0
-    wer = 0
-    num_wer = 0
-    sent_acc = 0
-    num_sent_acc = 0
+    loss_sum = torch.zeros((), device=device)
+    loss_n = 0
+    correct_symbols = torch.zeros((), dtype=torch.long, device=device)
+    total_symbols = torch.zeros((), dtype=torch.long, device=device)
+    pad_id = data_loader.dataset.token_to_id[PAD]
+    id_to_token = data_loader.dataset.id_to_token
+    metric_copier = _MetricCopier()
 
     with tqdm(desc=f"{epoch_text} Validation", total=len(data_loader.dataset), dynamic_ncols=True, leave=False) as pbar:
         for d in data_loader:
-            input = d["image"].to(device).float()
+            input = d["image"].to(device, non_blocking=True).float().contiguous(memory_format=torch.channels_last)
 
             curr_batch_size = len(input)
-            expected = d["truth"]["encoded"].to(device)
+            expected = d["truth"]["encoded"].to(device, non_blocking=True)
 
-            expected[expected==-1] = data_loader.dataset.token_to_id[PAD]
-            with autocast():
-                output = model(input, expected, False, teacher_forcing_ratio)
+            expected_in = torch.where(expected == -1, pad_id, expected)
+            with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=device.type == "cuda"):
+                output = model(input, expected_in, False, teacher_forcing_ratio)
 
                 decoded_values = output.transpose(1, 2)
-                _, sequence = torch.topk(decoded_values, 1, dim=1)
-                sequence = sequence.squeeze(1)
+                sequence = decoded_values.argmax(dim=1)
 
-                loss = criterion(decoded_values, expected[:, 1:])
+                loss = criterion(decoded_values, expected_in[:, 1:])
 
-            losses.append(loss.item())
+            loss_sum += loss.detach()
+            loss_n += 1
             
-            expected[expected == data_loader.dataset.token_to_id[PAD]] = -1
-            expected_str = id_to_string(expected, data_loader,do_eval=1)
-            sequence_str = id_to_string(sequence, data_loader,do_eval=1)
-            wer += word_error_rate(sequence_str,expected_str)
-            num_wer += 1
-            sent_acc += sentence_acc(sequence_str,expected_str)
-            num_sent_acc += 1
-            correct_symbols += torch.sum(sequence == expected[:, 1:], dim=(0, 1)).item()
-            total_symbols += torch.sum(expected[:, 1:] != -1, dim=(0, 1)).item()
+            batch_correct, batch_total = _count_symbols(sequence, expected[:, 1:], metric_scratch)
+            correct_symbols += batch_correct
+            total_symbols += batch_total
+
+            # 예측/정답을 non_blocking으로 CPU에 옮기고 문자열 변환 및 WER 계산은 worker에서 수행
+            metric_copier.put(sequence, expected[:, 1:])
 
             pbar.update(curr_batch_size)
 
-    expected = id_to_string(expected, data_loader)
-    sequence = id_to_string(sequence, data_loader)
+    expected = id_to_string(expected, id_to_token)
+    sequence = id_to_string(sequence, id_to_token)
     # print("-" * 10 + "GT valid")
     # print(*expected[:3], sep="\n")
     # print("-" * 10 + "PR valid")
     # print(*sequence[:3], sep="\n")
 
-    result = {
-        "loss": np.mean(losses),
-        "correct_symbols": correct_symbols,
-        "total_symbols": total_symbols,
-        "wer": wer,
-        "num_wer":num_wer,
-        "sent_acc": sent_acc,
-        "num_sent_acc":num_sent_acc
-    }
-    return result
-
-def run_epoch(
-    data_loader,
-    model,
-    epoch_text,
-    criterion,
-    optimizer,
-    lr_scheduler,
-    teacher_forcing_ratio,
-    max_grad_norm,
-    device,
-    train=True,
-):
-    # Disables autograd during validation mode
-    torch.set_grad_enabled(train)
-    if train:
-        model.train()
-    else:
-        model.eval()
-
-    losses = []
-    grad_norms = []
-    correct_symbols = 0
-    total_symbols = 0
-    wer = 0
-    num_wer = 0
-    sent_acc = 0
-    num_sent_acc = 0
-
-    with tqdm(
-        desc="{} ({})".format(epoch_text, "Train" if train else "Validation"),
-        total=len(data_loader.dataset),
-        dynamic_ncols=True,
-        leave=False,
-    ) as pbar:
-        for d in data_loader:
-            input = d["image"].to(device)
-
-            # The last batch may not be a full batch
-            curr_batch_size = len(input)
-            expected = d["truth"]["encoded"].to(device)
-
-            # Replace -1 with the PAD token
-            expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
-
-            output = model(input, expected, train, teacher_forcing_ratio)
-            
-            decoded_values = output.transpose(1, 2)
-            _, sequence = torch.topk(decoded_values, 1, dim=1)
-            sequence = sequence.squeeze(1)
-            
-            loss = criterion(decoded_values, expected[:, 1:])
-
-            if train:
-                optim_params = [
-                    p
-                    for param_group in optimizer.param_groups
-                    for p in param_group["params"]
-                ]
-                optimizer.zero_grad()
-                loss.backward()
-                # Clip gradients, it returns the total norm of all parameters
-                grad_norm = nn.utils.clip_grad_norm_(
-                    optim_params, max_norm=max_grad_norm
-                )
-                grad_norms.append(grad_norm)
-
-                # cycle
-                lr_scheduler.step()
-                optimizer.step()
-
-                # log lr
-                wandb.log({"learning_rate": lr_scheduler.get_lr()})
-
-            losses.append(loss.item())
-            
-            expected[expected == data_loader.dataset.token_to_id[PAD]] = -1
-            expected_str = id_to_string(expected, data_loader,do_eval=1)
-            sequence_str = id_to_string(sequence, data_loader,do_eval=1)
-            wer += word_error_rate(sequence_str,expected_str)
-            num_wer += 1
-            sent_acc += sentence_acc(sequence_str,expected_str)
-            num_sent_acc += 1
-            correct_symbols += torch.sum(sequence == expected[:, 1:], dim=(0, 1)).item()
-            total_symbols += torch.sum(expected[:, 1:] != -1, dim=(0, 1)).item()
-
-            pbar.update(curr_batch_size)
-
-    expected = id_to_string(expected, data_loader)
-    sequence = id_to_string(sequence, data_loader)
-    print("-" * 10 + "GT ({})".format("train" if train else "valid"))
-    print(*expected[:3], sep="\n")
-    print("-" * 10 + "PR ({})".format("train" if train else "valid"))
-    print(*sequence[:3], sep="\n")
+    batch_metrics = metric_copier.results()
 
     result = {
-        "loss": np.mean(losses),
-        "correct_symbols": correct_symbols,
-        "total_symbols": total_symbols,
-        "wer": wer,
-        "num_wer":num_wer,
-        "sent_acc": sent_acc,
-        "num_sent_acc":num_sent_acc
+        "loss": (loss_sum / loss_n).item(),
+        "correct_symbols": correct_symbols.item(),
+        "total_symbols": total_symbols.item(),
+        "wer": sum(batch_wer for batch_wer, _ in batch_metrics),
+        "num_wer": len(batch_metrics),
+        "sent_acc": sum(batch_sent_acc for _, batch_sent_acc in batch_metrics),
+        "num_sent_acc": len(batch_metrics)
     }
-    if train:
-        try:
-            result["grad_norm"] = np.mean([tensor.cpu() for tensor in grad_norms])
-        except:
-            result["grad_norm"] = np.mean(grad_norms)
-
     return result
 
 def get_train_transforms(height, width):
@@ -335,9 +389,13 @@ def main(config_file):
     Train math formula recognition model
     """
     options = Flags(config_file).get()
+    # 체크포인트에 함께 저장할 config (학습 중 변하지 않으므로 한 번만 읽음)
+    with open(config_file, 'r') as f:
+        option_dict = yaml.safe_load(f)
     
     # set random seed
-    set_seed(seed=options.seed)
+    # 입력 이미지 크기가 고정이므로 cudnn_benchmark를 켜면 cuDNN이 (channels_last) conv 커널을 고름 (기본은 재현성 유지)
+    set_seed(seed=options.seed, cudnn_benchmark=getattr(options, "cudnn_benchmark", False))
 
     
     
@@ -390,6 +448,7 @@ def main(config_file):
 
     train_data_loader, validation_data_loader, train_dataset, valid_dataset = dataset_loader(options, train_transform=get_train_transforms(options.input_size.height, options.input_size.width), valid_transform=get_valid_transforms(options.input_size.height, options.input_size.width))
     # train_data_loader, validation_data_loader, train_dataset, valid_dataset = dataset_loader(options, transformed, transformed)
+    start_metric_pool(train_dataset.id_to_token, train_dataset.token_to_id)
     print(
         "[+] Data\n",
         "The number of train samples : {}\n".format(len(train_dataset)),
@@ -405,11 +464,27 @@ def main(config_file):
         device,
         train_dataset,
     )
+    model = model.to(memory_format=torch.channels_last)
+    if getattr(options, "gradient_checkpointing", False):
+        model = enable_gradient_checkpointing(model)
+    if getattr(options, "compile", False):
+        # torch.compile / TF32 matmul 설정은 torch>=2.0에서만 지원
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("options.compile requires torch>=2.0 (see requirements.txt)")
+        # capture_train_step이 CUDA Graph를 직접 capture하므로 graph를 따로 기록하는 compile과 함께 쓰지 않음
+        if getattr(options, "cuda_graph", False):
+            raise ValueError("options.compile cannot be combined with options.cuda_graph")
+        torch.set_float32_matmul_precision("high")
+        # teacher forcing 비율에 따라 decoder가 autoregressive 경로를 타므로 fullgraph=False,
+        # batch마다 sequence 길이가 바뀌고 validation은 step마다 길이가 늘어나므로 기본 mode + dynamic shape 자동 감지
+        model = torch.compile(model, fullgraph=False, dynamic=None)
     model.train()
 
     # define loss
     # criterion = model.criterion.to(device)
-    criterion = get_criterion(type=options.criterion).to(device)
+    # CUDA Graph 사용 시 target이 max_seq_len까지 PAD로 채워지므로 loss 평균에서 PAD를 제외
+    ignore_index = train_dataset.token_to_id[PAD] if getattr(options, "cuda_graph", False) else -100
+    criterion = get_criterion(type=options.criterion, ignore_index=ignore_index).to(device)
 
     # define optimizer
     enc_params_to_optimise = [
@@ -465,6 +540,21 @@ def main(config_file):
             )
 
 
+    # pre-Ampere GPU는 bf16을 지원하지 않으므로 fp16 + GradScaler로 학습
+    amp_dtype = get_amp_dtype(device)
+    scaler = GradScaler(enabled=is_cuda and amp_dtype == torch.float16)
+
+    # CUDA Graph: 고정 shape(drop_last + max_seq_len)의 teacher forcing 학습 step을 capture
+    graph_step = None
+    if getattr(options, "cuda_graph", False):
+        if not is_cuda or options.teacher_forcing_ratio < 1 or getattr(options, "max_seq_len", None) is None:
+            raise ValueError("cuda_graph requires CUDA, teacher_forcing_ratio == 1 and max_seq_len")
+        d = next(iter(train_data_loader))
+        sample_input = d["image"].to(device).float().contiguous(memory_format=torch.channels_last)
+        sample_expected = d["truth"]["encoded"].to(device)
+        sample_expected = torch.where(sample_expected == -1, train_dataset.token_to_id[PAD], sample_expected)
+        graph_step = capture_train_step(model, criterion, sample_input, sample_expected, amp_dtype, scaler)
+
     # Log for W&B
     wandb.config.update(dict(options._asdict())) # logging to W&B
 
@@ -475,7 +565,6 @@ def main(config_file):
     shutil.copy(config_file, os.path.join(options.prefix, "train_config.yaml"))
     if options.print_epochs is None:
         options.print_epochs = options.num_epochs
-    writer = init_tensorboard(name=options.prefix.strip("-"))
     start_epoch = checkpoint["epoch"]
     train_symbol_accuracy = checkpoint["train_symbol_accuracy"]
     train_sentence_accuracy = checkpoint["train_sentence_accuracy"]
@@ -488,9 +577,13 @@ def main(config_file):
     learning_rates = checkpoint["lr"]
     grad_norms = checkpoint["grad_norm"]
 
-    scaler = GradScaler()
+    # symbol accuracy 계산용 bool 버퍼를 한 번만 할당해 train/valid에서 재사용
+    scratch_len = getattr(options, "max_seq_len", None) or 1
+    metric_scratch = {"eq": torch.empty((options.batch_size, scratch_len), dtype=torch.bool, device=device)}
+    metric_scratch["ne"] = torch.empty_like(metric_scratch["eq"])
 
     best_sentence_acc = 0.0
+    ckpt_interval = getattr(options, "ckpt_interval", 1)
 
     # Train
     for epoch in range(options.num_epochs):
@@ -504,20 +597,7 @@ def main(config_file):
         )
 
         # Train
-        # train_result = run_epoch(
-        #     train_data_loader,
-        #     model,
-        #     epoch_text,
-        #     criterion,
-        #     optimizer,
-        #     lr_scheduler,
-        #     options.teacher_forcing_ratio,
-        #     options.max_grad_norm,
-        #     device,
-        #     train=True,
-        # )
-
-        train_result = train_one_epoch(train_data_loader, model, epoch_text, criterion, optimizer, lr_scheduler, options.teacher_forcing_ratio, options.max_grad_norm, device, scaler)
+        train_result = train_one_epoch(train_data_loader, model, epoch_text, criterion, optimizer, lr_scheduler, options.teacher_forcing_ratio, options.max_grad_norm, device, metric_scratch, amp_dtype, scaler, graph_step)
 
         train_losses.append(train_result["loss"])
         grad_norms.append(train_result["grad_norm"])
@@ -539,20 +619,7 @@ def main(config_file):
         epoch_lr = lr_scheduler.get_lr()  # cycle
 
         # Validation
-        # validation_result = run_epoch(
-        #     validation_data_loader,
-        #     model,
-        #     epoch_text,
-        #     criterion,
-        #     optimizer,
-        #     lr_scheduler,
-        #     options.teacher_forcing_ratio,
-        #     options.max_grad_norm,
-        #     device,
-        #     train=False,
-        # )
-
-        validation_result = valid_one_epoch(validation_data_loader, model, epoch_text, criterion, device, teacher_forcing_ratio=options.teacher_forcing_ratio)
+        validation_result = valid_one_epoch(validation_data_loader, model, epoch_text, criterion, device, teacher_forcing_ratio=options.teacher_forcing_ratio, metric_scratch=metric_scratch, amp_dtype=amp_dtype)
 
         validation_losses.append(validation_result["loss"])
         validation_epoch_symbol_accuracy = (
@@ -572,10 +639,10 @@ def main(config_file):
         validation_epoch_score = final_metric(sentence_acc=validation_epoch_sentence_accuracy, word_error_rate=validation_epoch_wer)
 
         # Save checkpoint
-        # make config
-        with open(config_file, 'r') as f:
-            option_dict = yaml.safe_load(f)
-        if best_sentence_acc < 0.9*validation_epoch_sentence_accuracy + 0.1*(1-validation_epoch_wer):
+        is_best = best_sentence_acc < 0.9*validation_epoch_sentence_accuracy + 0.1*(1-validation_epoch_wer)
+        # optimizer state를 포함한 resume용 체크포인트는 ckpt_interval epoch마다 저장
+        save_latest = (epoch + 1) % ckpt_interval == 0 or epoch == options.num_epochs - 1
+        if is_best or save_latest:
             save_checkpoint(
                 {
                     "epoch": start_epoch + epoch + 1,
@@ -589,7 +656,7 @@ def main(config_file):
                     "validation_wer":validation_wer,
                     "lr": epoch_lr,
                     "grad_norm": grad_norms,
-                    "model": model.state_dict(),
+                    "model": getattr(model, "_orig_mod", model).state_dict(), # torch.compile 시 원본 module 기준으로 저장
                     "optimizer": optimizer.state_dict(),
                     "configs": option_dict,
                     "token_to_id":train_data_loader.dataset.token_to_id,
@@ -597,7 +664,10 @@ def main(config_file):
                     "network": options.network
                 },
                 prefix=options.prefix,
+                is_best=is_best,
+                save_latest=save_latest,
             )
+        if is_best:
             best_sentence_acc = 0.9*validation_epoch_sentence_accuracy + 0.1*(1-validation_epoch_wer)
             print(f"best sentence acc: {best_sentence_acc}")
             print("model is saved")
@@ -634,20 +704,6 @@ def main(config_file):
             print(output_string)
             log_file.write(output_string + "\n")
 
-            write_tensorboard(
-                writer=writer,
-                epoch=start_epoch+epoch +1,
-                grad_norm=train_result["grad_norm"],
-                train_loss=train_result["loss"],
-                train_symbol_accuracy=train_epoch_symbol_accuracy,
-                train_sentence_accuracy=train_epoch_sentence_accuracy,
-                train_wer=train_epoch_wer,
-                validation_loss=validation_result["loss"],
-                validation_symbol_accuracy=validation_epoch_symbol_accuracy,
-                validation_sentence_accuracy=validation_epoch_sentence_accuracy,
-                validation_wer=validation_epoch_wer,
-                model=model
-            )
             write_wandb(
                 epoch=start_epoch+epoch +1,
                 grad_norm=train_result["grad_norm"],
@@ -660,7 +716,8 @@ def main(config_file):
                 validation_symbol_accuracy=validation_epoch_symbol_accuracy,
                 validation_sentence_accuracy=validation_epoch_sentence_accuracy,
                 validation_wer=validation_epoch_wer,
-                validation_score=validation_epoch_sentence_accuracy*0.9 + ((1-validation_epoch_wer)*0.1)
+                validation_score=validation_epoch_sentence_accuracy*0.9 + ((1-validation_epoch_wer)*0.1),
+                lr=epoch_lr
             )
 
 
@@ -692,6 +749,9 @@ if __name__ == "__main__":
     # train
     main(parser.config_file)
 
+    # 백그라운드 체크포인트 저장 완료 대기
+    wait_for_checkpoints()
+
     # fishe W&B
     run.finish()
 
@@ -5,6 +5,7 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
 from networks.Attention import Attention
 from networks.SATRN import SATRN
 from networks.SWIN import SWIN
@@ -35,6 +36,30 @@ def get_network(
 
     return model
 
+def enable_gradient_checkpointing(model):
+    """encoder/decoder의 attention layer들에 activation checkpointing 적용 (attention_layers가 있는 SATRN 계열만 지원)
+
+    학습(grad 활성) 중에는 각 layer의 activation을 저장하지 않고 backward 때 재계산해
+    메모리를 아끼고, inference 시에는 원래 forward를 그대로 사용
+    """
+    def wrap(forward):
+        def checkpointed_forward(*args, **kwargs):
+            if torch.is_grad_enabled():
+                return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+            return forward(*args, **kwargs)
+        return checkpointed_forward
+
+    num_wrapped = 0
+    for name in ("encoder", "decoder"):
+        for layer in getattr(getattr(model, name, None), "attention_layers", []):
+            layer.forward = wrap(layer.forward)
+            num_wrapped += 1
+    if num_wrapped == 0:
+        raise NotImplementedError(
+            f"gradient_checkpointing is not supported for {type(model).__name__} (no attention_layers found)"
+        )
+    return model
+
 def get_optimizer(optimizer, params, lr, weight_decay=None):
     if optimizer == "Adam":
         optimizer = optim.Adam(params, lr=lr)
@@ -59,13 +84,16 @@ def print_system_envs():
     )
 
 # Fixed version of id_to_string
-def id_to_string(tokens, data_loader, do_eval=0):
+def id_to_string(tokens, id_to_token, do_eval=0, token_to_id=None):
+    # do_eval 시 special token id 조회에 token_to_id 사용 (hot loop에서는 미리 꺼내둔 dict를 넘길 것)
     result = []
     if do_eval:
-        eos_id = data_loader.dataset.token_to_id["<EOS>"]
+        if token_to_id is None:
+            token_to_id = {token: i for i, token in id_to_token.items()}
+        eos_id = token_to_id["<EOS>"]
         special_ids = set([
-            data_loader.dataset.token_to_id["<PAD>"],
-            data_loader.dataset.token_to_id["<SOS>"],
+            token_to_id["<PAD>"],
+            token_to_id["<SOS>"],
             eos_id
             ])
 
@@ -76,14 +104,14 @@ def id_to_string(tokens, data_loader, do_eval=0):
                 token = token.item()
                 if token not in special_ids:
                     if token != -1:
-                        string += data_loader.dataset.id_to_token[token] + " "
+                        string += id_to_token[token] + " "
                 elif token == eos_id:
                     break
         else:
             for token in example:
                 token = token.item()
                 if token != -1:
-                    string += data_loader.dataset.id_to_token[token] + " "
+                    string += id_to_token[token] + " "
 
         result.append(string)
     return result
@@ -116,12 +144,13 @@ def id_to_string(tokens, data_loader, do_eval=0):
 #     return result
 
 
-def set_seed(seed: int=21):
+def set_seed(seed: int=21, cudnn_benchmark: bool=False):
+    """cudnn_benchmark=True면 cuDNN이 conv 커널을 직접 골라 빨라지지만 실행마다 결과가 달라질 수 있음"""
     torch.manual_seed(seed)
     np.random.seed(seed)
     random.seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = not cudnn_benchmark
+    torch.backends.cudnn.benchmark = cudnn_benchmark
 
 def get_timestamp():
     return datetime.now().strftime(format='%m%d-%H%M%S')
\ No newline at end of file
@@ -112,8 +112,8 @@ def validate(parser):
                 )
 
                 expected[expected == valid_data_loader.dataset.token_to_id[PAD]] = -1
-                expected_str = id_to_string(expected, valid_data_loader, do_eval=1)
-                sequence_str = id_to_string(sequence, valid_data_loader, do_eval=1)
+                expected_str = id_to_string(expected, valid_data_loader.dataset.id_to_token, do_eval=1, token_to_id=valid_data_loader.dataset.token_to_id)
+                sequence_str = id_to_string(sequence, valid_data_loader.dataset.id_to_token, do_eval=1, token_to_id=valid_data_loader.dataset.token_to_id)
                 wer += word_error_rate(sequence_str, expected_str)
                 num_wer += 1
                 sent_acc += sentence_acc(sequence_str, expected_str)